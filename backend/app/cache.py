@@ -0,0 +1,12 @@
+from app.events import redis_client
+
+
+CONTENT_HASH_TTL_SECONDS = 3600
+
+
+def content_hash_key(content_sha256: str) -> str:
+    return f"media:hash:{content_sha256}"
+
+
+def remember_content_hash(content_sha256: str, media_task_id: str) -> None:
+    redis_client.set(content_hash_key(content_sha256), media_task_id, ex=CONTENT_HASH_TTL_SECONDS)
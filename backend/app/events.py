@@ -0,0 +1,141 @@
+import asyncio
+import json
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from typing import Any
+
+import asyncpg
+import redis
+
+from app.config import settings
+
+
+TASK_STATE_TTL_SECONDS = 3600
+PG_TASK_CHANNEL = "media_task_updates"
+
+redis_client = redis.Redis.from_url(settings.redis_url)
+
+
+def task_channel(media_task_id: str) -> str:
+    return f"task:{media_task_id}"
+
+
+def task_state_key(media_task_id: str) -> str:
+    return f"task:{media_task_id}:state"
+
+
+def decode_task_state(raw: dict[bytes, bytes]) -> dict[str, Any] | None:
+    state = {key.decode(): json.loads(value) for key, value in raw.items()}
+    # A hash holding only progress was written before the first Postgres sync and is incomplete.
+    return state if "status" in state else None
+
+
+def save_task_state(media_task_id: str, state: dict[str, Any]) -> dict[str, Any]:
+    key = task_state_key(media_task_id)
+    pipe = redis_client.pipeline()
+    pipe.hset(key, mapping={name: json.dumps(value) for name, value in state.items()})
+    pipe.expire(key, TASK_STATE_TTL_SECONDS)
+    pipe.hgetall(key)
+    *_, raw = pipe.execute()
+    return {name.decode(): json.loads(value) for name, value in raw.items()}
+
+
+def update_task_progress(media_task_id: str, progress: int) -> dict[str, Any] | None:
+    key = task_state_key(media_task_id)
+    pipe = redis_client.pipeline()
+    pipe.hset(key, "progress", json.dumps(progress))
+    pipe.expire(key, TASK_STATE_TTL_SECONDS)
+    pipe.hgetall(key)
+    *_, raw = pipe.execute()
+    return decode_task_state(raw)
+
+
+def publish_task_update(media_task_id: str, state: dict[str, Any]) -> None:
+    payload = {"task_id": media_task_id, **state}
+    redis_client.publish(task_channel(media_task_id), json.dumps(payload))
+
+
+# pg_notify raises on payloads of 8000 bytes or more, and that error would roll back the
+# UPDATE itself, so error_message is truncated and large outputs are left for the listener
+# to read from the row.
+TASK_NOTIFY_DDL = (
+    """
+    CREATE OR REPLACE FUNCTION notify_media_task_update() RETURNS trigger AS $$
+    DECLARE
+        payload jsonb;
+    BEGIN
+        payload := jsonb_build_object(
+            'task_id', NEW.id,
+            'status', NEW.status,
+            'progress', NEW.progress,
+            'error_message', left(NEW.error_message, 1000)
+        );
+        IF octet_length((payload || jsonb_build_object('outputs', NEW.outputs))::text) < 7900 THEN
+            payload := payload || jsonb_build_object('outputs', NEW.outputs);
+        END IF;
+        PERFORM pg_notify('media_task_updates', payload::text);
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE TRIGGER media_notify
+    AFTER UPDATE ON media_tasks
+    FOR EACH ROW EXECUTE FUNCTION notify_media_task_update()
+    """,
+)
+DROP_TASK_NOTIFY_DDL = ("DROP TRIGGER IF EXISTS media_notify ON media_tasks",)
+
+
+class PgTaskListener:
+    """One LISTEN connection per process, fanning notifications out to per-task queues."""
+
+    def __init__(self, dsn: str):
+        self._dsn = dsn
+        self._conn: asyncpg.Connection | None = None
+        self._lock = asyncio.Lock()
+        self._queues: dict[str, set[asyncio.Queue]] = {}
+
+    async def connect(self) -> None:
+        async with self._lock:
+            if self._conn is not None and not self._conn.is_closed():
+                return
+            conn = await asyncpg.connect(self._dsn)
+            conn.add_termination_listener(self._on_terminate)
+            await conn.add_listener(PG_TASK_CHANNEL, self._on_notify)
+            self._conn = conn
+
+    async def close(self) -> None:
+        if self._conn is not None:
+            await self._conn.close()
+
+    def _on_notify(self, _conn, _pid, _channel, data: str) -> None:
+        payload = json.loads(data)
+        for queue in self._queues.get(payload["task_id"], ()):
+            queue.put_nowait(payload)
+
+    def _on_terminate(self, _conn) -> None:
+        # Updates sent while disconnected are lost, so end every stream; the next
+        # subscriber reconnects and clients reseed from Postgres.
+        self._conn = None
+        for queues in self._queues.values():
+            for queue in queues:
+                queue.put_nowait(None)
+
+    @asynccontextmanager
+    async def subscribe(self, media_task_id: str) -> AsyncIterator[AsyncIterator[dict[str, Any]]]:
+        queue: asyncio.Queue = asyncio.Queue()
+        self._queues.setdefault(media_task_id, set()).add(queue)
+
+        async def notifications():
+            while (payload := await queue.get()) is not None:
+                yield payload
+
+        try:
+            await self.connect()
+            yield notifications()
+        finally:
+            subscribers = self._queues[media_task_id]
+            subscribers.discard(queue)
+            if not subscribers:
+                del self._queues[media_task_id]
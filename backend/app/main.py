@@ -1,21 +1,60 @@
 import asyncio
+import hashlib
+import json
+import logging
+import uuid
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager, suppress
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
+from typing import Any, BinaryIO
 from uuid import UUID
 
+import redis.asyncio as aioredis
 from celery.result import AsyncResult
-from fastapi import Depends, FastAPI, File, Form, HTTPException, UploadFile, WebSocket, WebSocketDisconnect
+from fastapi import (
+    Depends,
+    FastAPI,
+    File,
+    Form,
+    HTTPException,
+    Response,
+    UploadFile,
+    WebSocket,
+    WebSocketDisconnect,
+)
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import func, select
+from sqlalchemy import func, make_url, select
 from sqlalchemy.orm import Session
 
+from app.cache import CONTENT_HASH_TTL_SECONDS, content_hash_key
 from app.celery_app import celery_app
 from app.config import settings
 from app.database import Base, SessionLocal, engine, get_db
+from app.events import (
+    DROP_TASK_NOTIFY_DDL,
+    TASK_NOTIFY_DDL,
+    PgTaskListener,
+    decode_task_state,
+    redis_client,
+    task_channel,
+    task_state_key,
+)
 from app.models import MediaTask
 from app.schemas import TaskResponse, UploadResponse
-from app.tasks import run_media_pipeline
+from app.tasks import _file_kind, run_media_pipeline
+
+# uvicorn only configures its own loggers; the root logger stays at WARNING.
+logger = logging.getLogger("uvicorn.error")
+
+TERMINAL_STATUSES = {"completed", "failed"}
+UPLOAD_CHUNK_SIZE = 1 << 20
 
 app = FastAPI(title=settings.app_name)
+redis_async = aioredis.Redis.from_url(settings.redis_url)
+pg_listener = PgTaskListener(
+    make_url(settings.database_url).set(drivername="postgresql").render_as_string(hide_password=False)
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -32,6 +71,29 @@ def startup():
     settings.media_output_dir.mkdir(parents=True, exist_ok=True)
     settings.media_thumb_dir.mkdir(parents=True, exist_ok=True)
     Base.metadata.create_all(bind=engine)
+    notify_ddl = TASK_NOTIFY_DDL if settings.task_updates_backend == "postgres" else DROP_TASK_NOTIFY_DDL
+    with engine.begin() as conn:
+        for statement in notify_ddl:
+            conn.exec_driver_sql(statement)
+
+    # Upload hashing relies on the OpenSSL sha256 (_hashlib), which uses SHA-NI / ARMv8
+    # crypto extensions; CPython's builtin fallback is several times slower.
+    sha256_backend = type(hashlib.sha256()).__module__
+    if sha256_backend != "_hashlib":
+        logger.warning("SHA-256 upload hashing is not using OpenSSL (backend: %s)", sha256_backend)
+    else:
+        logger.info("SHA-256 upload hashing backend: %s", sha256_backend)
+
+
+@app.on_event("startup")
+async def start_pg_listener():
+    if settings.task_updates_backend == "postgres":
+        await pg_listener.connect()
+
+
+@app.on_event("shutdown")
+async def stop_pg_listener():
+    await pg_listener.close()
 
 
 @app.get("/health")
@@ -39,8 +101,52 @@ def health_check():
     return {"status": "ok"}
 
 
-@app.post("/media/upload", response_model=UploadResponse)
+async def _find_completed_by_hash(db: Session, content_sha256: str, suffix: str) -> MediaTask | None:
+    # Only rows that ran the pipeline own their output files; reused rows copy another row's
+    # paths with a fresh updated_at. Local outputs are removed by cleanup_old_media, so the
+    # source row must also be inside that window.
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=settings.cleanup_max_age_hours)
+
+    cached_id = await redis_async.get(content_hash_key(content_sha256))
+    if cached_id:
+        row = db.get(MediaTask, UUID(cached_id.decode()))
+        if (
+            row
+            and row.status == "completed"
+            and row.celery_task_id is not None
+            and row.updated_at >= cutoff
+            and Path(row.original_filename).suffix.casefold() == suffix
+        ):
+            return row
+
+    stmt = (
+        select(MediaTask)
+        .where(
+            MediaTask.content_sha256 == content_sha256,
+            MediaTask.status == "completed",
+            MediaTask.celery_task_id.is_not(None),
+            MediaTask.updated_at >= cutoff,
+            # Variants keep the source container, so outputs are only valid for the same extension.
+            func.lower(MediaTask.original_filename).endswith(suffix, autoescape=True),
+        )
+        .order_by(MediaTask.updated_at.desc())
+        .limit(1)
+    )
+    return db.execute(stmt).scalars().first()
+
+
+def _store_upload(source: BinaryIO, destination: Path) -> str:
+    digest = hashlib.sha256()
+    with destination.open("wb") as out:
+        while chunk := source.read(UPLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+            out.write(chunk)
+    return digest.hexdigest()
+
+
+@app.post("/media/upload", response_model=UploadResponse, status_code=202)
 async def upload_media(
+    response: Response,
     file: UploadFile = File(...),
     user_id: str = Form(...),
     db: Session = Depends(get_db),
@@ -50,35 +156,59 @@ async def upload_media(
         MediaTask.status.in_(["queued", "processing"]),
     )
     active_count = db.execute(active_stmt).scalar_one()
+    # End the quota read's transaction so the connection returns to the pool during the copy.
+    db.rollback()
     if active_count >= settings.max_active_tasks_per_user:
         raise HTTPException(
             status_code=429,
             detail=f"Task quota exceeded. Max active tasks per user: {settings.max_active_tasks_per_user}",
         )
 
+    # The body is already spooled by Starlette; copy and hash it off the event loop.
+    media_task_id = uuid.uuid4()
     safe_name = Path(file.filename or "upload.bin").name
+    source_path = settings.media_input_dir / f"{media_task_id}_{safe_name}"
+    content_sha256 = await asyncio.to_thread(_store_upload, file.file, source_path)
+
     media_row = MediaTask(
+        id=media_task_id,
         user_id=user_id,
         original_filename=safe_name,
         status="queued",
         progress=0,
-        source_path="",
+        source_path=str(source_path),
+        content_sha256=content_sha256,
         outputs={},
     )
     db.add(media_row)
-    db.flush()
 
-    source_path = settings.media_input_dir / f"{media_row.id}_{safe_name}"
-    content = await file.read()
-    source_path.write_bytes(content)
+    # Unsupported formats must still reach validation and fail there, not reuse another upload's outputs.
+    try:
+        _file_kind(Path(safe_name))
+    except ValueError:
+        previous = None
+    else:
+        previous = await _find_completed_by_hash(db, content_sha256, Path(safe_name).suffix.casefold())
+    if previous:
+        # The pipeline will not run, so the stored copy is never read.
+        source_path.unlink(missing_ok=True)
+        media_row.source_path = ""
+        media_row.status = "completed"
+        media_row.progress = 100
+        media_row.outputs = dict(previous.outputs)
+        media_row.thumbnail_path = previous.thumbnail_path
+        db.commit()
+        await redis_async.set(content_hash_key(content_sha256), str(previous.id), ex=CONTENT_HASH_TTL_SECONDS)
+        response.status_code = 200
+        return UploadResponse(task_id=media_task_id, celery_id=None, status="completed")
 
-    media_row.source_path = str(source_path)
-    async_result = run_media_pipeline(str(media_row.id), str(source_path))
+    # Publish before committing: if the broker call fails the row rolls back instead of
+    # sitting in the user's active quota with no Celery task behind it. The publish is a
+    # blocking kombu call, so run it off the event loop; the 202 still waits for it.
+    async_result = await asyncio.to_thread(run_media_pipeline, str(media_task_id), str(source_path), content_sha256)
     media_row.celery_task_id = async_result.id
     db.commit()
-    db.refresh(media_row)
-
-    return UploadResponse(task_id=media_row.id, celery_id=async_result.id, status=media_row.status)
+    return UploadResponse(task_id=media_task_id, celery_id=async_result.id, status="queued")
 
 
 @app.get("/media/tasks/{task_id}", response_model=TaskResponse)
@@ -86,42 +216,111 @@ def get_task_status(task_id: UUID, db: Session = Depends(get_db)):
     row = db.get(MediaTask, task_id)
     if not row:
         raise HTTPException(status_code=404, detail="Task not found")
-    return TaskResponse.model_validate(row)
+    response = TaskResponse.model_validate(row)
+    if settings.task_updates_backend != "redis":
+        return response
+    state = decode_task_state(redis_client.hgetall(task_state_key(str(task_id))))
+    return response.model_copy(update=state) if state else response
+
+
+def _fetch_task_snapshot(task_id: UUID) -> dict[str, Any] | None:
+    with SessionLocal() as db:
+        row = db.get(MediaTask, task_id)
+        if not row:
+            return None
+
+        celery_state = None
+        celery_meta = None
+        if row.celery_task_id:
+            result = AsyncResult(row.celery_task_id, app=celery_app)
+            celery_state = result.state
+            celery_meta = result.info if isinstance(result.info, dict) else None
+
+        return {
+            "task_id": str(row.id),
+            "status": row.status,
+            "progress": row.progress,
+            "error_message": row.error_message,
+            "outputs": row.outputs,
+            "celery": {"state": celery_state, "meta": celery_meta},
+        }
+
+
+@asynccontextmanager
+async def _task_update_stream(task_id: str) -> AsyncIterator[AsyncIterator[dict[str, Any]]]:
+    if settings.task_updates_backend == "postgres":
+        async with pg_listener.subscribe(task_id) as notifications:
+
+            async def rows():
+                async for payload in notifications:
+                    # The trigger drops outputs that would overflow the NOTIFY payload.
+                    if "outputs" not in payload:
+                        payload = await asyncio.to_thread(_fetch_task_snapshot, UUID(task_id)) or payload
+                    yield payload
+
+            yield rows()
+    else:
+        pubsub = redis_async.pubsub()
+        await pubsub.subscribe(task_channel(task_id))
+
+        async def messages():
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    yield json.loads(message["data"])
+
+        try:
+            yield messages()
+        finally:
+            await pubsub.unsubscribe()
+            await pubsub.aclose()
+
+
+async def _wait_for_disconnect(websocket: WebSocket):
+    while (await websocket.receive())["type"] != "websocket.disconnect":
+        continue
 
 
 @app.websocket("/ws/tasks/{task_id}")
 async def task_updates(task_id: UUID, websocket: WebSocket):
     await websocket.accept()
     try:
-        while True:
-            db = SessionLocal()
-            row = db.get(MediaTask, task_id)
-            if not row:
+        # Subscribe before seeding so no update published in between is lost.
+        async with _task_update_stream(str(task_id)) as updates:
+            # Sync SQLAlchemy and the Celery result backend would block every socket on this loop.
+            payload = await asyncio.to_thread(_fetch_task_snapshot, task_id)
+            if payload is None:
                 await websocket.send_json({"error": "Task not found"})
-                db.close()
-                break
-
-            celery_state = None
-            celery_meta = None
-            if row.celery_task_id:
-                result = AsyncResult(row.celery_task_id, app=celery_app)
-                celery_state = result.state
-                celery_meta = result.info if isinstance(result.info, dict) else None
-
-            payload = {
-                "task_id": str(row.id),
-                "status": row.status,
-                "progress": row.progress,
-                "error_message": row.error_message,
-                "outputs": row.outputs,
-                "celery": {"state": celery_state, "meta": celery_meta},
-            }
-            await websocket.send_json(payload)
-            db.close()
+                return
 
-            if row.status in {"completed", "failed"}:
-                break
+            if settings.task_updates_backend == "redis":
+                state = decode_task_state(await redis_async.hgetall(task_state_key(str(task_id))))
+                if state:
+                    payload.update(state)
+
+            await websocket.send_json(payload)
+            if payload["status"] in TERMINAL_STATUSES:
+                return
 
-            await asyncio.sleep(1)
+            # Nothing is sent while waiting on the stream, so watch the socket as well;
+            # otherwise a closed client keeps its subscription until the task finishes.
+            disconnected = asyncio.create_task(_wait_for_disconnect(websocket))
+            try:
+                while True:
+                    next_update = asyncio.ensure_future(anext(updates))
+                    await asyncio.wait({next_update, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+                    if not next_update.done():
+                        next_update.cancel()
+                        with suppress(asyncio.CancelledError):
+                            await next_update
+                        return
+                    try:
+                        payload = next_update.result()
+                    except StopAsyncIteration:
+                        return
+                    await websocket.send_json(payload)
+                    if payload["status"] in TERMINAL_STATUSES:
+                        return
+            finally:
+                disconnected.cancel()
     except WebSocketDisconnect:
         return
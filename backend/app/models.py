@@ -1,7 +1,7 @@
 import uuid
 from datetime import datetime
 
-from sqlalchemy import DateTime, Integer, String, Text, func
+from sqlalchemy import DateTime, Index, Integer, String, Text, func, text
 from sqlalchemy.dialects.postgresql import JSONB, UUID
 from sqlalchemy.orm import Mapped, mapped_column
 
@@ -10,6 +10,14 @@ from app.database import Base
 
 class MediaTask(Base):
     __tablename__ = "media_tasks"
+    __table_args__ = (
+        # Serves the per-user active task quota check in upload_media.
+        Index(
+            "ix_media_tasks_user_active",
+            "user_id",
+            postgresql_where=text("status IN ('queued', 'processing')"),
+        ),
+    )
 
     id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     user_id: Mapped[str] = mapped_column(String(120), index=True)
@@ -18,6 +26,7 @@ class MediaTask(Base):
     progress: Mapped[int] = mapped_column(Integer, default=0)
     celery_task_id: Mapped[str | None] = mapped_column(String(100), nullable=True, index=True)
     source_path: Mapped[str] = mapped_column(Text)
+    content_sha256: Mapped[str | None] = mapped_column(String(64), nullable=True, index=True)
     thumbnail_path: Mapped[str | None] = mapped_column(Text, nullable=True)
     outputs: Mapped[dict] = mapped_column(JSONB, default=dict)
     error_message: Mapped[str | None] = mapped_column(Text, nullable=True)
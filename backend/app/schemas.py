@@ -7,7 +7,7 @@ from pydantic import BaseModel
 
 class UploadResponse(BaseModel):
     task_id: UUID
-    celery_id: str
+    celery_id: str | None
     status: str
 
 
@@ -1,19 +1,31 @@
+import threading
+from functools import lru_cache
 from pathlib import Path
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import BotoCoreError, ClientError
 
 from app.config import settings
 
 
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, max_concurrency=8, use_threads=True)
+# boto3's default session is not thread-safe, so concurrent first calls must not build clients in parallel.
+_client_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
 def get_s3_client():
-    return boto3.client(
-        "s3",
-        endpoint_url=settings.s3_endpoint_url,
-        aws_access_key_id=settings.s3_access_key,
-        aws_secret_access_key=settings.s3_secret_key,
-        region_name=settings.s3_region,
-    )
+    with _client_lock:
+        return boto3.client(
+            "s3",
+            endpoint_url=settings.s3_endpoint_url,
+            aws_access_key_id=settings.s3_access_key,
+            aws_secret_access_key=settings.s3_secret_key,
+            region_name=settings.s3_region,
+            config=Config(max_pool_connections=32, tcp_keepalive=True),
+        )
 
 
 def upload_file_to_storage(path: Path, object_key: str) -> str:
@@ -22,7 +34,7 @@ def upload_file_to_storage(path: Path, object_key: str) -> str:
 
     client = get_s3_client()
     try:
-        client.upload_file(str(path), settings.s3_bucket, object_key)
+        client.upload_file(str(path), settings.s3_bucket, object_key, Config=TRANSFER_CONFIG)
         return f"{settings.s3_public_base_url}/{settings.s3_bucket}/{object_key}"
     except (BotoCoreError, ClientError):
         return str(path)
@@ -1,22 +1,39 @@
 from __future__ import annotations
 
+import os
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from pathlib import Path
 from typing import Any
 from uuid import UUID
 
-from celery import Task, chain
-from PIL import Image, ImageDraw
-from sqlalchemy import func, select
+import pyvips
+from celery import Task
+from celery.signals import worker_process_init, worker_ready
+from sqlalchemy import func, select, update
 
+from app.cache import remember_content_hash
 from app.celery_app import celery_app
 from app.config import settings
-from app.database import SessionLocal
+from app.database import SessionLocal, engine
+from app.events import publish_task_update, save_task_state, update_task_progress
 from app.models import MediaTask
 from app.storage import upload_file_to_storage
 
 
+WATERMARK_TEXT = "Celery Demo"
+VIDEO_WATERMARK_FILTER = (
+    f"drawtext=text='{WATERMARK_TEXT}':x=20:y=20:fontcolor=white:fontsize=24:box=1:boxcolor=black@0.4"
+)
+
+_IMAGE_EXTS = frozenset({".jpg", ".jpeg", ".png", ".webp"})
+_VIDEO_EXTS = frozenset({".mp4", ".mov", ".mkv", ".webm"})
+_LOSSY_IMAGE_EXTS = frozenset({".jpg", ".jpeg", ".webp"})
+_EXT_KIND = {**dict.fromkeys(_IMAGE_EXTS, "image"), **dict.fromkeys(_VIDEO_EXTS, "video")}
+
+
 class TransientProcessingError(Exception):
     pass
 
@@ -40,16 +57,9 @@ class BaseMediaTask(Task):
         super().on_failure(exc, task_id, args, kwargs, einfo)
 
 
-def run_media_pipeline(media_task_id: str, input_path: str):
-    initial_ctx = {"media_task_id": media_task_id, "input_path": input_path}
-    return chain(
-        validate_media.s(),
-        generate_thumbnail.s(),
-        convert_resolutions.s(),
-        apply_watermark.s(),
-        upload_outputs.s(),
-        finalize_success.s(),
-    ).apply_async(args=[initial_ctx])
+def run_media_pipeline(media_task_id: str, input_path: str, content_sha256: str | None = None):
+    initial_ctx = {"media_task_id": media_task_id, "input_path": input_path, "content_sha256": content_sha256}
+    return process_media.apply_async(args=[initial_ctx])
 
 
 def update_media_row(
@@ -60,44 +70,78 @@ def update_media_row(
     error_message: str | None = None,
     thumbnail_path: str | None = None,
 ):
-    db = SessionLocal()
-    try:
-        row = db.get(MediaTask, UUID(media_task_id))
-        if not row:
+    # Progress-only updates are read over the WebSocket, so keep them in Redis and
+    # write Postgres only when a persisted field changes. The postgres backend needs
+    # every update committed, because its trigger is what notifies listeners.
+    use_redis = settings.task_updates_backend == "redis"
+    persisted = (status, outputs, error_message, thumbnail_path)
+    if use_redis and progress is not None and all(value is None for value in persisted):
+        state = update_task_progress(media_task_id, progress)
+        if state is not None:
+            publish_task_update(media_task_id, state)
             return
-        if status is not None:
-            row.status = status
-        if progress is not None:
-            row.progress = progress
-        if outputs is not None:
-            row.outputs = outputs
-        if error_message is not None:
-            row.error_message = error_message
-        if thumbnail_path is not None:
-            row.thumbnail_path = thumbnail_path
+
+    values = {
+        name: value
+        for name, value in (
+            ("status", status),
+            ("progress", progress),
+            ("outputs", outputs),
+            ("error_message", error_message),
+            ("thumbnail_path", thumbnail_path),
+        )
+        if value is not None
+    }
+    if not values:
+        return
+
+    # A single UPDATE ... RETURNING replaces the ORM SELECT + flush and still yields the row state.
+    stmt = (
+        update(MediaTask)
+        .where(MediaTask.id == UUID(media_task_id))
+        .values(**values)
+        .returning(MediaTask.status, MediaTask.progress, MediaTask.error_message, MediaTask.outputs)
+        .execution_options(synchronize_session=False)
+    )
+    with SessionLocal() as db:
+        row = db.execute(stmt).one_or_none()
         db.commit()
-    finally:
-        db.close()
+    if row is None or not use_redis:
+        return
+
+    state = dict(row._mapping)
+    if progress is None:
+        # Postgres lags behind Redis on progress; keep the live value unless one was passed.
+        row_progress = state.pop("progress")
+        state = save_task_state(media_task_id, state)
+        state.setdefault("progress", row_progress)
+    else:
+        state = save_task_state(media_task_id, state)
+    publish_task_update(media_task_id, state)
 
 
-def _ensure_dirs():
+@worker_process_init.connect
+def _reset_db_pool(**_kwargs):
+    # Each prefork child must open its own connections instead of reusing the parent's.
+    engine.dispose(close=False)
+
+
+@worker_ready.connect
+def _ensure_dirs(**_kwargs):
     settings.media_input_dir.mkdir(parents=True, exist_ok=True)
     settings.media_output_dir.mkdir(parents=True, exist_ok=True)
     settings.media_thumb_dir.mkdir(parents=True, exist_ok=True)
 
 
 def _file_kind(path: Path) -> str:
-    ext = path.suffix.lower()
-    if ext in {".jpg", ".jpeg", ".png", ".webp"}:
-        return "image"
-    if ext in {".mp4", ".mov", ".mkv", ".webm"}:
-        return "video"
-    raise ValueError(f"Unsupported media format: {ext}")
+    ext = path.suffix.casefold()
+    kind = _EXT_KIND.get(ext)
+    if kind is None:
+        raise ValueError(f"Unsupported media format: {ext}")
+    return kind
 
 
-@celery_app.task(bind=True, base=BaseMediaTask, name="app.tasks.validate_media")
-def validate_media(self, ctx: dict[str, Any]):
-    _ensure_dirs()
+def _validate_media(task: Task, ctx: dict[str, Any]):
     input_path = Path(ctx["input_path"])
     if not input_path.exists():
         raise ValueError("Uploaded source file does not exist")
@@ -110,29 +154,33 @@ def validate_media(self, ctx: dict[str, Any]):
     ctx["kind"] = kind
     ctx["size_bytes"] = size_bytes
     update_media_row(ctx["media_task_id"], status="processing", progress=10)
-    self.update_state(state="PROGRESS", meta={"progress": 10, "step": "validate"})
+    task.update_state(state="PROGRESS", meta={"progress": 10, "step": "validate"})
     return ctx
 
 
-@celery_app.task(bind=True, base=BaseMediaTask, name="app.tasks.generate_thumbnail")
-def generate_thumbnail(self, ctx: dict[str, Any]):
+def _generate_thumbnail(task: Task, ctx: dict[str, Any]):
     source = Path(ctx["input_path"])
     thumb_path = settings.media_thumb_dir / f"{source.stem}_thumb.jpg"
 
     if ctx["kind"] == "image":
-        with Image.open(source) as img:
-            img.thumbnail((320, 320))
-            img.convert("RGB").save(thumb_path, "JPEG")
+        # thumbnail() streams the source and uses shrink-on-load where the format supports it.
+        img = pyvips.Image.thumbnail(str(source), 320, height=320, size="down")
+        _to_srgb(img).jpegsave(str(thumb_path), Q=85)
     else:
+        # -ss before -i seeks the demuxer to the nearest keyframe instead of decoding up to 1s.
         cmd = [
             "ffmpeg",
             "-y",
-            "-i",
-            str(source),
             "-ss",
             "00:00:01",
+            "-i",
+            str(source),
             "-frames:v",
             "1",
+            "-vf",
+            "scale='min(320,iw)':'min(320,ih)':force_original_aspect_ratio=decrease",
+            "-q:v",
+            "3",
             str(thumb_path),
         ]
         result = subprocess.run(cmd, capture_output=True, text=True)
@@ -141,106 +189,98 @@ def generate_thumbnail(self, ctx: dict[str, Any]):
 
     ctx["thumbnail_path"] = str(thumb_path)
     update_media_row(ctx["media_task_id"], progress=25, thumbnail_path=str(thumb_path))
-    self.update_state(state="PROGRESS", meta={"progress": 25, "step": "thumbnail"})
+    task.update_state(state="PROGRESS", meta={"progress": 25, "step": "thumbnail"})
     return ctx
 
 
-@celery_app.task(bind=True, base=BaseMediaTask, name="app.tasks.convert_resolutions")
-def convert_resolutions(self, ctx: dict[str, Any]):
+def _to_srgb(img: pyvips.Image) -> pyvips.Image:
+    if img.hasalpha():
+        img = img.flatten()
+    return img.colourspace("srgb")
+
+
+@lru_cache(maxsize=1)
+def _watermark_overlay() -> pyvips.Image:
+    mask = pyvips.Image.text(WATERMARK_TEXT, dpi=72)
+    alpha = (mask * (160 / 255)).cast("uchar")
+    return mask.new_from_image([255, 255, 255]).bandjoin(alpha).copy(interpretation="srgb")
+
+
+def _watermark_image(img: pyvips.Image) -> pyvips.Image:
+    # Blend only the patch under the text and paste it back, not the whole frame.
+    overlay = _watermark_overlay()
+    width = min(overlay.width, img.width - 20)
+    height = min(overlay.height, img.height - 20)
+    if width <= 0 or height <= 0:
+        return img
+    patch = img.crop(20, 20, width, height).composite2(overlay.crop(0, 0, width, height), "over")
+    return img.insert(patch[:3].cast("uchar"), 20, 20)
+
+
+def _save_image(img: pyvips.Image, path: str):
+    options = {"Q": 85} if Path(path).suffix.casefold() in _LOSSY_IMAGE_EXTS else {}
+    img.write_to_file(path, **options)
+
+
+def _convert_resolutions(task: Task, ctx: dict[str, Any]):
     source = Path(ctx["input_path"])
     resolutions = [("1080p", 1920), ("720p", 1280), ("480p", 854)]
-    converted: list[dict[str, str]] = []
-
-    for label, width in resolutions:
-        out_name = f"{source.stem}_{label}{source.suffix}"
-        out_path = settings.media_output_dir / out_name
-        if ctx["kind"] == "image":
-            with Image.open(source) as img:
-                ratio = width / float(img.width)
-                height = max(1, int(img.height * ratio))
-                resized = img.resize((width, height))
-                resized.save(out_path)
-        else:
-            cmd = [
-                "ffmpeg",
-                "-y",
-                "-i",
-                str(source),
-                "-vf",
-                f"scale={width}:-2",
-                "-c:a",
-                "copy",
-                str(out_path),
-            ]
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            if result.returncode != 0:
-                raise TransientProcessingError(f"Failed to convert {label}")
-        converted.append({"label": label, "path": str(out_path)})
-
-    ctx["converted"] = converted
-    update_media_row(ctx["media_task_id"], progress=55)
-    self.update_state(state="PROGRESS", meta={"progress": 55, "step": "convert"})
-    return ctx
-
+    watermarked: list[dict[str, str]] = [
+        {"label": label, "path": str(settings.media_output_dir / f"{source.stem}_{label}_wm{source.suffix}")}
+        for label, _ in resolutions
+    ]
 
-@celery_app.task(bind=True, base=BaseMediaTask, name="app.tasks.apply_watermark")
-def apply_watermark(self, ctx: dict[str, Any]):
-    watermark_text = "Celery Demo"
-    watermarked: list[dict[str, str]] = []
-
-    for item in ctx["converted"]:
-        src = Path(item["path"])
-        dst = src.with_name(f"{src.stem}_wm{src.suffix}")
-        if ctx["kind"] == "image":
-            with Image.open(src).convert("RGBA") as img:
-                overlay = Image.new("RGBA", img.size, (0, 0, 0, 0))
-                draw = ImageDraw.Draw(overlay)
-                draw.text((20, 20), watermark_text, fill=(255, 255, 255, 160))
-                combined = Image.alpha_composite(img, overlay).convert("RGB")
-                combined.save(dst)
-        else:
-            cmd = [
-                "ffmpeg",
-                "-y",
-                "-i",
-                str(src),
-                "-vf",
-                "drawtext=text='Celery Demo':x=20:y=20:fontcolor=white:fontsize=24:box=1:boxcolor=black@0.4",
-                str(dst),
-            ]
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            if result.returncode != 0:
-                raise TransientProcessingError("Failed to watermark video")
-        watermarked.append({"label": item["label"], "path": str(dst)})
+    if ctx["kind"] == "image":
+        # Random access decodes the source once and every variant resizes from it;
+        # sequential access would force a fresh decode per output.
+        img = _to_srgb(pyvips.Image.new_from_file(str(source)))
+        for (_, width), item in zip(resolutions, watermarked):
+            resized = img.resize(width / img.width, kernel="linear")
+            _save_image(_watermark_image(resized), item["path"])
+    else:
+        # Decode once, fan the frames out to every variant and watermark each
+        # scaled stream in the same graph so only final files are encoded.
+        count = len(resolutions)
+        graph = f"[0:v]split={count}" + "".join(f"[v{i}]" for i in range(count))
+        for i, (_, width) in enumerate(resolutions):
+            graph += f";[v{i}]scale={width}:-2,{VIDEO_WATERMARK_FILTER}[o{i}]"
+
+        cmd = ["ffmpeg", "-y", "-i", str(source), "-filter_complex", graph]
+        for i, item in enumerate(watermarked):
+            cmd += ["-map", f"[o{i}]", "-map", "0:a?", "-c:a", "copy", item["path"]]
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise TransientProcessingError("Failed to convert and watermark video")
 
     ctx["watermarked"] = watermarked
     update_media_row(ctx["media_task_id"], progress=75)
-    self.update_state(state="PROGRESS", meta={"progress": 75, "step": "watermark"})
+    task.update_state(state="PROGRESS", meta={"progress": 75, "step": "convert"})
     return ctx
 
 
-@celery_app.task(bind=True, base=BaseMediaTask, name="app.tasks.upload_outputs")
-def upload_outputs(self, ctx: dict[str, Any]):
+def _upload_outputs(task: Task, ctx: dict[str, Any]):
     media_task_id = ctx["media_task_id"]
-    uploaded = []
-    for item in ctx["watermarked"]:
-        path = Path(item["path"])
-        object_key = f"{media_task_id}/{path.name}"
-        url = upload_file_to_storage(path, object_key)
-        uploaded.append({"label": item["label"], "url": url, "path": str(path)})
+    paths = [Path(item["path"]) for item in ctx["watermarked"]]
+    paths.append(Path(ctx["thumbnail_path"]))
 
-    thumb_key = f"{media_task_id}/{Path(ctx['thumbnail_path']).name}"
-    thumb_url = upload_file_to_storage(Path(ctx["thumbnail_path"]), thumb_key)
+    # Uploads are independent and I/O-bound, so run them concurrently on the shared client.
+    with ThreadPoolExecutor(max_workers=len(paths)) as pool:
+        urls = list(pool.map(lambda path: upload_file_to_storage(path, f"{media_task_id}/{path.name}"), paths))
+
+    *variant_urls, thumb_url = urls
+    uploaded = [
+        {"label": item["label"], "url": url, "path": item["path"]}
+        for item, url in zip(ctx["watermarked"], variant_urls)
+    ]
 
     ctx["uploaded"] = uploaded
     ctx["thumbnail_url"] = thumb_url
     update_media_row(ctx["media_task_id"], progress=90)
-    self.update_state(state="PROGRESS", meta={"progress": 90, "step": "upload"})
+    task.update_state(state="PROGRESS", meta={"progress": 90, "step": "upload"})
     return ctx
 
 
-@celery_app.task(bind=True, base=BaseMediaTask, name="app.tasks.finalize_success")
-def finalize_success(self, ctx: dict[str, Any]):
+def _finalize_success(task: Task, ctx: dict[str, Any]):
     outputs = {
         "thumbnail": ctx["thumbnail_url"],
         "variants": [{"label": x["label"], "url": x["url"]} for x in ctx["uploaded"]],
@@ -252,33 +292,50 @@ def finalize_success(self, ctx: dict[str, Any]):
         outputs=outputs,
         error_message=None,
     )
-    self.update_state(state="SUCCESS", meta={"progress": 100, "step": "done"})
+    if ctx.get("content_sha256"):
+        remember_content_hash(ctx["content_sha256"], ctx["media_task_id"])
+    task.update_state(state="SUCCESS", meta={"progress": 100, "step": "done"})
     return outputs
 
 
+@celery_app.task(bind=True, base=BaseMediaTask, name="app.tasks.process_media")
+def process_media(self, ctx: dict[str, Any]):
+    # Every stage runs on the same worker, so call them in-process instead of
+    # chaining separate tasks through the broker. A transient error retries the run.
+    ctx = dict(ctx)
+    for stage in (_validate_media, _generate_thumbnail, _convert_resolutions, _upload_outputs):
+        ctx = stage(self, ctx)
+    return _finalize_success(self, ctx)
+
+
 @celery_app.task(name="app.tasks.cleanup_old_media")
 def cleanup_old_media():
     now = datetime.now(timezone.utc)
     cutoff = now - timedelta(hours=settings.cleanup_max_age_hours)
 
+    cutoff_ts = cutoff.timestamp()
+
     cleaned_files = 0
     for root in [settings.media_input_dir, settings.media_output_dir, settings.media_thumb_dir]:
         root.mkdir(parents=True, exist_ok=True)
-        for path in root.glob("*"):
-            if not path.is_file():
-                continue
-            modified = datetime.fromtimestamp(path.stat().st_mtime, tz=timezone.utc)
-            if modified < cutoff:
-                path.unlink(missing_ok=True)
-                cleaned_files += 1
+        # scandir entries carry d_type and cache stat(), so each file costs a single syscall.
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                if entry.stat(follow_symlinks=False).st_mtime < cutoff_ts:
+                    try:
+                        os.unlink(entry.path)
+                    except FileNotFoundError:
+                        continue
+                    cleaned_files += 1
 
     return {"cleaned_files": cleaned_files, "cutoff": cutoff.isoformat()}
 
 
 @celery_app.task(name="app.tasks.generate_daily_report")
 def generate_daily_report():
-    db = SessionLocal()
-    try:
+    with SessionLocal() as db:
         yesterday = datetime.now(timezone.utc) - timedelta(hours=24)
         stmt = (
             select(MediaTask.status, func.count(MediaTask.id))
@@ -288,5 +345,3 @@ def generate_daily_report():
         rows = db.execute(stmt).all()
         report = {status: count for status, count in rows}
         return {"window_start": yesterday.isoformat(), "counts": report}
-    finally:
-        db.close()